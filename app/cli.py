@@ -4,9 +4,20 @@ from pathlib import Path
 import getpass
 import os
 import logging
+import logging.handlers
+import atexit
+import queue
+import io
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from tests.test import (
     test_basic_encrypt_decrypt,
+    test_stream_encrypt_decrypt,
+    test_legacy_decrypt_chunks,
+    test_prefetch_pipeline,
+    test_sandbox_paths,
     test_avalanche_effect,
     test_entropy_analysis,
     test_performance_benchmark,
@@ -14,11 +25,13 @@ from tests.test import (
     test_bit_balance
 )
 from src.crypto_utils import (
-    aesgcm_encrypt, aesgcm_decrypt,
+    aesgcm_encrypt_stream, aesgcm_decrypt_stream, aesgcm_decrypt_chunks,
+    STREAM_MAGIC,
     gen_master_key,
     create_escrow, recover_master_key,
-    ensure_in_sandbox, read_bytes_safe, write_bytes_safe
+    ensure_in_sandbox, read_chunks_safe, write_chunks_safe
 )
+from src.pipeline import prefetch
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 SANDBOX = PROJECT_ROOT / "sandbox"
@@ -46,7 +59,12 @@ def setup_logging():
     )
     file_handler.setFormatter(formatter)
     
-    logger.addHandler(file_handler)
+    # El logger solo encola; un hilo en segundo plano escribe al archivo
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     
     return logger
 
@@ -84,6 +102,14 @@ def load_master_key():
 
     return master
 
+def clear_screen():
+    """Limpia la terminal; en POSIX con una secuencia ANSI, sin lanzar un proceso."""
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        sys.stdout.write('\x1b[H\x1b[2J')
+        sys.stdout.flush()
+
 def cmd_encrypt(in_file, out_file):
     infile = SANDBOX / "input" / in_file
     outfile = SANDBOX / "output" / out_file
@@ -97,14 +123,28 @@ def cmd_encrypt(in_file, out_file):
 
     master = load_master_key()
 
-    plaintext = read_bytes_safe(infile, SANDBOX)
-    encrypted = aesgcm_encrypt(master, plaintext)
+    # Se escribe a un temporal y solo se publica si todo el pipeline terminó
+    tmpfile = outfile.with_name(outfile.name + ".part")
+
+    # Pipeline: lectura -> cifrado -> escritura, cada etapa en su hilo
+    chunks = prefetch(read_chunks_safe(infile, SANDBOX))
+    encrypted = prefetch(aesgcm_encrypt_stream(master, chunks))
+    try:
+        write_chunks_safe(tmpfile, encrypted, SANDBOX)
+    except Exception:
+        # Cerrar cada etapa detiene sus hilos productores
+        encrypted.close()
+        chunks.close()
+        tmpfile.unlink(missing_ok=True)
+        print("ERROR: No se pudo cifrar el archivo.")
+        input("Presione Enter para continuar...")
+        sys.exit(2)
 
-    write_bytes_safe(outfile, encrypted, SANDBOX)
+    tmpfile.replace(outfile)
 
     print(f"[OK] Archivo cifrado: {outfile}")
     input("Presione Enter para continuar...")
-    os.system('cls' if os.name == 'nt' else 'clear')
+    clear_screen()
 
 def cmd_decrypt(args):
     infile = SANDBOX / "output" / args.infile
@@ -120,48 +160,108 @@ def cmd_decrypt(args):
 
     master = load_master_key()
 
-    encrypted = read_bytes_safe(infile, SANDBOX)
+    size = infile.stat().st_size
+    # Se escribe a un temporal y solo se publica si el tag es válido
+    tmpfile = outfile.with_name(outfile.name + ".part")
+    chunks = plaintext = None
 
     try:
-        plaintext = aesgcm_decrypt(master, encrypted)
+        if size < 12 + 16:
+            raise ValueError("Blob cifrado inválido")
+        magic = b"".join(read_chunks_safe(infile, SANDBOX, 0, len(STREAM_MAGIC)))
+        if magic == STREAM_MAGIC:
+            chunks = prefetch(read_chunks_safe(infile, SANDBOX))
+            plaintext = prefetch(aesgcm_decrypt_stream(master, chunks))
+        else:
+            # Archivos cifrados con el formato anterior (un solo mensaje GCM)
+            nonce = b"".join(read_chunks_safe(infile, SANDBOX, 0, 12))
+            tag = b"".join(read_chunks_safe(infile, SANDBOX, size - 16, size))
+            chunks = prefetch(read_chunks_safe(infile, SANDBOX, 12, size - 16))
+            plaintext = prefetch(aesgcm_decrypt_chunks(master, nonce, tag, chunks))
+        write_chunks_safe(tmpfile, plaintext, SANDBOX)
     except Exception:
+        for stage in (plaintext, chunks):
+            if stage is not None:
+                stage.close()
+        tmpfile.unlink(missing_ok=True)
         print("ERROR: No se pudo descifrar. Archivo corrupto.")
         input("Presione Enter para continuar...")
         sys.exit(2)
 
-    write_bytes_safe(outfile, plaintext, SANDBOX)
+    tmpfile.replace(outfile)
 
     print(f"[OK] Archivo descifrado: {outfile}")
     input("Presione Enter para continuar...")
-    os.system('cls' if os.name == 'nt' else 'clear')
+    clear_screen()
+
+def _run_test(test_func):
+    """Ejecuta un test en un proceso del pool; devuelve (error, salida capturada)."""
+    out = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(out):
+        try:
+            test_func()
+        except Exception as e:
+            error = str(e) or type(e).__name__
+    return error, out.getvalue()
 
 def cmd_test(args):
     """Ejecuta todos los tests criptográficos."""
+    if args is not None and args.no_plots:
+        os.environ["CIFRA_NO_PLOTS"] = "1"
+
     print("[INFO] Ejecutando suite completa de tests...")
     print("=" * 50)
     
-    tests = [
+    # Tests estadísticos/funcionales: independientes, se ejecutan en paralelo
+    parallel_tests = [
         ("test_basic_encrypt_decrypt", test_basic_encrypt_decrypt),
+        ("test_stream_encrypt_decrypt", test_stream_encrypt_decrypt),
+        ("test_legacy_decrypt_chunks", test_legacy_decrypt_chunks),
+        ("test_prefetch_pipeline", test_prefetch_pipeline),
+        ("test_sandbox_paths", test_sandbox_paths),
         ("test_avalanche_effect", test_avalanche_effect),
         ("test_entropy_analysis", test_entropy_analysis),
+        ("test_bit_balance", test_bit_balance),
+    ]
+    # Benchmarks de tiempo: uno tras otro y sin otros procesos compitiendo
+    # por la CPU, para no distorsionar los MB/s medidos
+    timed_tests = [
         ("test_performance_benchmark", test_performance_benchmark),
         ("test_multiple_data_sizes", test_multiple_data_sizes),
-        ("test_bit_balance", test_bit_balance),
     ]
     
     passed = 0
     failed = 0
     
-    for test_name, test_func in tests:
-        try:
-            print(f"[RUN] {test_name}...", end=" ", flush=True)
-            test_func()
+    def report(test_name, error, output):
+        nonlocal passed, failed
+        print(f"[RUN] {test_name}...", end=" ")
+        print(output, end="")
+        if error is None:
             print("✓ PASADO")
             passed += 1
-        except Exception as e:
-            print(f"✗ FALLO: {e}")
+        else:
+            print(f"✗ FALLO: {error}")
             failed += 1
     
+    # La salida de cada test se imprime completa al terminar, para no
+    # entremezclarla. "spawn": cli.py ya tiene hilos vivos (logging) y
+    # fork() con hilos puede bloquear al hijo.
+    workers = min(len(parallel_tests), os.cpu_count() or 1)
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+        futures = {ex.submit(_run_test, test_func): test_name for test_name, test_func in parallel_tests}
+        for future in as_completed(futures):
+            try:
+                error, output = future.result()
+            except Exception as e:
+                error, output = str(e), ""
+            report(futures[future], error, output)
+    
+    for test_name, test_func in timed_tests:
+        report(test_name, *_run_test(test_func))
+    
     print("=" * 50)
     print(f"[RESULT] Pasados: {passed}, Fallos: {failed}")
     
@@ -200,7 +300,7 @@ def menu_interactive():
         elif option == 'd':
             cmd_test(None)
         elif option == 'cls':
-            os.system('cls' if os.name == 'nt' else 'clear')
+            clear_screen()
         elif option == 'exit':
             print("Saliendo...")
             run = False
@@ -220,6 +320,12 @@ def build_parser():
         help='Ejecutar suite completa de tests criptográficos'
     )
     
+    parser.add_argument(
+        '--no-plots',
+        action='store_true',
+        help='Ejecutar los tests sin generar gráficos'
+    )
+    
     parser.add_argument(
         '--menu',
         action='store_true',
@@ -234,7 +340,7 @@ def main(argv=None):
     
     # Si se pasa --tests, ejecutar todos los tests
     if args.tests:
-        cmd_test(None)
+        cmd_test(args)
         return
     
     # Si se pasa --menu o sin argumentos, abrir menú interactivo
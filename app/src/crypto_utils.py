@@ -1,19 +1,55 @@
 '''Este archivo contiene utilidades criptográficas para generar claves'''
 
 import os
+import ssl
+import hashlib
+import logging
+import functools
+import threading
 from pathlib import Path
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+logger = logging.getLogger('cifra')
+
+IO_CHUNK = 16 << 20  # 16 MiB por operación de lectura/escritura
+
 # CLAVE MAESTRA
 def gen_master_key():
     return os.urandom(32)  
 
+# NONCES: se sirven de un buffer de os.urandom para no hacer un syscall por mensaje
+_NONCE_POOL_SIZE = 4096
+_nonce_lock = threading.Lock()
+_nonce_pool = memoryview(b"")
+
+def _reset_nonce_pool():
+    # Un hijo de fork() no debe reutilizar los nonces pendientes del padre, ni
+    # heredar el lock tomado si otro hilo lo tenía en el momento del fork
+    global _nonce_pool, _nonce_lock
+    _nonce_lock = threading.Lock()
+    _nonce_pool = memoryview(b"")
+
+os.register_at_fork(after_in_child=_reset_nonce_pool)
+
+def _nonce(n: int = 12) -> bytes:
+    global _nonce_pool
+    with _nonce_lock:
+        if len(_nonce_pool) < n:
+            _nonce_pool = memoryview(os.urandom(_NONCE_POOL_SIZE))
+        out = bytes(_nonce_pool[:n])
+        _nonce_pool = _nonce_pool[n:]
+    return out
+
 # CIFRADO / DESCIFRADO AES-GCM
+@functools.lru_cache(maxsize=8)
+def _get_aesgcm(key: bytes):
+    # Reutiliza el contexto (key schedule + tabla GHASH) entre llamadas
+    return AESGCM(key)
+
 def aesgcm_encrypt(key: bytes, plaintext: bytes):
-    aes = AESGCM(key)
-    nonce = os.urandom(12)
+    aes = _get_aesgcm(key)
+    nonce = _nonce()
     ciphertext = aes.encrypt(nonce, plaintext, None)
     return nonce + ciphertext
 
@@ -23,18 +59,93 @@ def aesgcm_decrypt(key: bytes, blob: bytes):
 
     nonce = blob[:12]
     ct = blob[12:]
-    aes = AESGCM(key)
+    aes = _get_aesgcm(key)
     return aes.decrypt(nonce, ct, None)
 
+# AES-GCM en streaming con registros enmarcados:
+#   cabecera: STREAM_MAGIC || prefijo (8 bytes)
+#   registro: longitud (4 bytes) || ct || tag, nonce = prefijo || contador (4 bytes)
+# El AAD marca el último registro para detectar truncados.
+STREAM_MAGIC = b"CFS1"
+STREAM_CHUNK = 1 << 20  # 1 MiB por registro
+
+def _fill(buf: bytearray, it, n: int):
+    while len(buf) < n:
+        chunk = next(it, None)
+        if chunk is None:
+            return False
+        buf += chunk
+    return True
+
+def aesgcm_encrypt_stream(key: bytes, chunks, chunk_size: int = STREAM_CHUNK):
+    if not 0 < chunk_size <= STREAM_CHUNK:
+        raise ValueError(f"chunk_size debe estar entre 1 y {STREAM_CHUNK}")
+    aes = _get_aesgcm(key)
+    prefix = os.urandom(8)
+    yield STREAM_MAGIC + prefix
+
+    it = iter(chunks)
+    buf = bytearray()
+    counter = 0
+    while True:
+        # Se retiene un byte extra para saber si el registro es el último
+        last = not _fill(buf, it, chunk_size + 1)
+        if counter >= 1 << 32:
+            raise ValueError("Archivo demasiado grande para el flujo")
+        nonce = prefix + counter.to_bytes(4, 'big')
+        ct = aes.encrypt(nonce, bytes(buf[:chunk_size]), b"\x01" if last else b"\x00")
+        del buf[:chunk_size]
+        yield len(ct).to_bytes(4, 'big')
+        yield ct
+        if last:
+            return
+        counter += 1
+
+def aesgcm_decrypt_stream(key: bytes, chunks):
+    aes = _get_aesgcm(key)
+    it = iter(chunks)
+    buf = bytearray()
+    if not _fill(buf, it, 12) or buf[:4] != STREAM_MAGIC:
+        raise ValueError("Cabecera de flujo inválida")
+    prefix = bytes(buf[4:12])
+    del buf[:12]
+
+    counter = 0
+    while True:
+        if not _fill(buf, it, 4):
+            raise ValueError("Flujo cifrado truncado")
+        n = int.from_bytes(buf[:4], 'big')
+        # Se valida antes de leer: una longitud corrupta no debe hacer que se
+        # acumule el resto del archivo en memoria
+        if not 16 <= n <= STREAM_CHUNK + 16:
+            raise ValueError("Longitud de registro inválida")
+        if not _fill(buf, it, 4 + n):
+            raise ValueError("Flujo cifrado truncado")
+        ct = bytes(buf[4:4 + n])
+        del buf[:4 + n]
+        last = not _fill(buf, it, 1)
+        nonce = prefix + counter.to_bytes(4, 'big')
+        yield aes.decrypt(nonce, ct, b"\x01" if last else b"\x00")
+        if last:
+            return
+        counter += 1
+
+# Formato anterior (nonce || ct || tag de un solo mensaje GCM), solo descifrado.
+def aesgcm_decrypt_chunks(key: bytes, nonce: bytes, tag: bytes, chunks):
+    # El texto plano se entrega antes de verificar el tag: si finalize()
+    # lanza InvalidTag, el llamador debe descartar todo lo recibido.
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, tag)).decryptor()
+    for chunk in chunks:
+        yield decryptor.update(chunk)
+    decryptor.finalize()
+
 # ESCROW (clave maestra cifrada con passphrase)
 def derive_key(passphrase: str, salt: bytes):
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=200_000,
-    )
-    return kdf.derive(passphrase.encode())
+    # hashlib.pbkdf2_hmac delega en PKCS5_PBKDF2_HMAC de OpenSSL, que usa SHA-NI
+    # cuando la CPU lo soporta. Se registra aquí (no al importar) para que el
+    # handler de cli.setup_logging ya exista.
+    logger.debug("Backend PBKDF2: hashlib (%s)", ssl.OPENSSL_VERSION)
+    return hashlib.pbkdf2_hmac('sha256', passphrase.encode(), salt, 200_000, 32)
 
 
 def create_escrow(master_key: bytes, passphrase: str) -> bytes:
@@ -52,19 +163,45 @@ def recover_master_key(blob: bytes, passphrase: str):
 
 
 # SANDBOX: seguridad de rutas
+@functools.lru_cache(maxsize=8)
+def _resolve_sandbox(sandbox_root: Path):
+    return sandbox_root.resolve()
+
 def ensure_in_sandbox(path: Path, sandbox_root: Path):
     path_resolved = path.resolve()
-    sandbox_resolved = sandbox_root.resolve()
-    if not str(path_resolved).startswith(str(sandbox_resolved)):
+    # Solo se cachean raíces absolutas: una relativa depende del cwd actual
+    if sandbox_root.is_absolute():
+        sandbox_resolved = _resolve_sandbox(sandbox_root)
+    else:
+        sandbox_resolved = sandbox_root.resolve()
+    # Comparación por componentes: /sandbox2 no cuenta como dentro de /sandbox
+    if not path_resolved.is_relative_to(sandbox_resolved):
         raise PermissionError(f"Intento de acceso fuera de sandbox: {path_resolved}")
 
 
-def read_bytes_safe(path: Path, sandbox_root: Path):
+def read_chunks_safe(path: Path, sandbox_root: Path, start: int = 0, stop: int | None = None):
     ensure_in_sandbox(path, sandbox_root)
-    return path.read_bytes()
-
-
-def write_bytes_safe(path: Path, data: bytes, sandbox_root: Path):
+    with open(path, 'rb', buffering=0) as f:
+        if stop is None:
+            stop = os.fstat(f.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), start, stop - start, os.POSIX_FADV_SEQUENTIAL)
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(IO_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def write_chunks_safe(path: Path, chunks, sandbox_root: Path):
     ensure_in_sandbox(path, sandbox_root)
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_bytes(data)
+    with open(path, 'wb', buffering=0) as f:
+        for chunk in chunks:
+            view = memoryview(chunk)
+            pos = 0
+            while pos < len(view):
+                pos += f.write(view[pos:])
@@ -0,0 +1,54 @@
+'''Utilidades para encadenar etapas de lectura, cifrado y escritura en hilos'''
+
+import queue
+import threading
+
+_END = object()
+
+def prefetch(iterable, depth=2):
+    """Consume un iterable en un hilo aparte y entrega sus elementos por una cola acotada.
+
+    Encadenar varias llamadas solapa lectura, cifrado y escritura. Al cerrar
+    el generador el hilo productor termina; las etapas se cierran de la
+    última a la primera.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # put() con timeout para poder abandonar si el consumidor ya no lee
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put((_END, e))
+            return
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        put((_END, None))
+
+    thread = threading.Thread(target=worker, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if type(item) is tuple and item[0] is _END:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        # Tras el join el iterable de origen ya no está en uso y se puede cerrar
+        stop.set()
+        thread.join()
@@ -0,0 +1,40 @@
+'''Núcleos numéricos de los tests (histograma de bytes y entropía).
+
+Se compilan con Numba si está instalado; si no, se usan equivalentes en NumPy.
+'''
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+if HAS_NUMBA:
+    _jit = njit(cache=True, fastmath=True, boundscheck=False)
+
+    @_jit
+    def byte_histogram(a):
+        hist = np.zeros(256, dtype=np.int64)
+        for i in range(a.size):
+            hist[a[i]] += 1
+        return hist
+
+    @_jit
+    def shannon_from_hist(hist, n):
+        h = 0.0
+        for c in hist:
+            if c > 0:
+                p = c / n
+                h -= p * np.log2(p)
+        return h
+
+else:
+    def byte_histogram(a):
+        return np.bincount(a, minlength=256)
+
+    def shannon_from_hist(hist, n):
+        p = hist[hist > 0] / n
+        return -(p * np.log2(p)).sum()
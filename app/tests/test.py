@@ -1,8 +1,19 @@
-import subprocess, sys, os, time
+import subprocess, sys, os, time, secrets
+import functools
+import itertools
+import tempfile
+import threading
 from pathlib import Path
-import math
-from collections import Counter
-from src.crypto_utils import aesgcm_decrypt, aesgcm_encrypt, gen_master_key
+import numpy as np
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from src.crypto_utils import (
+    aesgcm_decrypt, aesgcm_encrypt, gen_master_key,
+    aesgcm_encrypt_stream, aesgcm_decrypt_stream, aesgcm_decrypt_chunks,
+    ensure_in_sandbox
+)
+from src.pipeline import prefetch
+from tests._kernels import byte_histogram, shannon_from_hist
 
 try:
     import matplotlib.pyplot as plt
@@ -19,26 +30,42 @@ ESCROW = ROOT / "escrow"
 OUTPUT_DIR = Path(__file__).resolve().parent / "results"
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-TEST_KEY = gen_master_key()
+# zlib nivel 1: PNG ~20% más grande pero mucho más rápido de codificar
+PLOT_DPI = 80
+PLOT_PIL_KWARGS = {"compress_level": 1}
+
+def plots_enabled() -> bool:
+    # CIFRA_NO_PLOTS=1 (o `cli.py --tests --no-plots`) omite los gráficos
+    return HAS_MATPLOTLIB and not os.environ.get("CIFRA_NO_PLOTS")
+
+# Clave y AESGCM se crean al primer uso (no al importar) y se reutilizan
+@functools.lru_cache(maxsize=None)
+def _test_key() -> bytes:
+    return gen_master_key()
+
+@functools.lru_cache(maxsize=None)
+def _test_aes() -> AESGCM:
+    return AESGCM(_test_key())
 
 def cifrar_descifrar(data: bytes) -> bytes:
-    blob = aesgcm_encrypt(TEST_KEY, data)
-    result = aesgcm_decrypt(TEST_KEY, blob)
+    key = _test_key()
+    blob = aesgcm_encrypt(key, data)
+    result = aesgcm_decrypt(key, blob)
     return result
 
 def hamming_distance(b1: bytes, b2: bytes) -> int:
-    return sum(bin(x ^ y).count("1") for x, y in zip(b1, b2))
+    # XOR como enteros grandes + popcount en C (int.bit_count, Python 3.10+)
+    return (int.from_bytes(b1, 'big') ^ int.from_bytes(b2, 'big')).bit_count()
 
 def entropy(data: bytes) -> float:
-    cnt = Counter(data)
-    total = len(data)
-    if len(cnt) == 0:
+    arr = np.frombuffer(data, dtype=np.uint8)
+    if arr.size == 0:
         return 0
-    return -sum((c/total) * math.log2(c/total) for c in cnt.values())
+    return float(shannon_from_hist(byte_histogram(arr), arr.size))
 
 def bit_histogram(data: bytes):
-    bits = "".join(f"{byte:08b}" for byte in data)
-    return bits.count("0"), bits.count("1")
+    ones = int.from_bytes(data, 'big').bit_count()
+    return len(data) * 8 - ones, ones
 
 
 # ============= TESTS CON MÚLTIPLES DATOS =============
@@ -51,17 +78,170 @@ def test_basic_encrypt_decrypt():
     print("✓ Test básico: PASADO")
 
 
+def test_stream_encrypt_decrypt():
+    """Test round-trip del formato en streaming (registros de tamaño fijo)."""
+    chunk_size = 1024
+    key = _test_key()
+    for size in [0, 1, chunk_size - 1, chunk_size, chunk_size + 1, 5 * chunk_size + 7]:
+        data = os.urandom(size)
+        # Bloques de entrada que no coinciden con el tamaño de registro
+        chunks = [data[i:i + 300] for i in range(0, size, 300)]
+        blob = b"".join(aesgcm_encrypt_stream(key, chunks, chunk_size))
+        assert b"".join(aesgcm_decrypt_stream(key, [blob])) == data, f"Fallo en tamaño {size}"
+
+        # Un flujo truncado debe rechazarse
+        if size > chunk_size:
+            truncated = blob[:12 + 4 + chunk_size + 16]
+            try:
+                b"".join(aesgcm_decrypt_stream(key, [truncated]))
+            except Exception:
+                pass
+            else:
+                raise AssertionError(f"Flujo truncado aceptado en tamaño {size}")
+
+    # Una longitud de registro corrupta se rechaza sin leer el resto del flujo
+    header = next(aesgcm_encrypt_stream(key, [b"x"], chunk_size))
+    consumed = []
+    def rest():
+        for i in range(64):
+            consumed.append(i)
+            yield bytes(chunk_size)
+    try:
+        b"".join(aesgcm_decrypt_stream(key, itertools.chain([header + b"\xff\xff\xff\xff"], rest())))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Longitud de registro corrupta aceptada")
+    assert not consumed, f"Se leyeron {len(consumed)} bloques tras una longitud inválida"
+    print("✓ Test streaming: PASADO")
+
+
+def test_legacy_decrypt_chunks():
+    """Test del formato anterior (nonce || ct || tag) descifrado por bloques, como en cmd_decrypt."""
+    key = _test_key()
+    for size in [0, 1000, (256 << 10) + 3]:
+        data = os.urandom(size)
+        blob = aesgcm_encrypt(key, data)
+
+        def descifrar(blob):
+            # Mismos desplazamientos que cmd_decrypt para archivos sin cabecera CFS1
+            nonce, tag, body = blob[:12], blob[-16:], blob[12:-16]
+            chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]
+            return b"".join(aesgcm_decrypt_chunks(key, nonce, tag, chunks))
+
+        assert descifrar(blob) == data, f"Fallo en tamaño {size}"
+
+        # Un byte alterado en el tag o en el ciphertext debe rechazarse
+        positions = [len(blob) - 1] + ([12 + size // 2] if size else [])
+        for pos in positions:
+            corrupted = bytearray(blob)
+            corrupted[pos] ^= 1
+            try:
+                descifrar(bytes(corrupted))
+            except InvalidTag:
+                pass
+            else:
+                raise AssertionError(f"Blob alterado aceptado en tamaño {size}, byte {pos}")
+    print("✓ Test formato anterior: PASADO")
+
+
+def test_prefetch_pipeline():
+    """Test del pipeline en hilos: al fallar el consumidor no quedan hilos productores vivos."""
+    def prefetch_threads():
+        return [t for t in threading.enumerate() if t.name == "prefetch" and t.is_alive()]
+
+    def source(n, fail_at=None):
+        for i in range(n):
+            if i == fail_at:
+                raise RuntimeError("fallo en origen")
+            yield bytes([i % 256]) * 64
+
+    # Round-trip a través de dos etapas
+    first = prefetch(source(50))
+    second = prefetch(b.upper() for b in first)
+    assert len(list(second)) == 50
+    assert not prefetch_threads(), "Hilos vivos tras un pipeline completo"
+
+    # El consumidor falla a mitad: con las colas llenas los productores
+    # quedan esperando en put() hasta que se cierran las etapas
+    first = prefetch(source(1000))
+    second = prefetch(b for b in first)
+    try:
+        for i, _ in enumerate(second):
+            if i == 3:
+                raise OSError("disco lleno")
+    except OSError:
+        second.close()
+        first.close()
+    assert not prefetch_threads(), f"Hilos productores vivos: {prefetch_threads()}"
+
+    # Una excepción en el origen llega al consumidor
+    first = prefetch(source(10, fail_at=5))
+    second = prefetch(b for b in first)
+    try:
+        list(second)
+    except RuntimeError as e:
+        assert str(e) == "fallo en origen"
+    else:
+        raise AssertionError("La excepción del origen no llegó al consumidor")
+    assert not prefetch_threads(), "Hilos vivos tras un fallo en el origen"
+    print("✓ Test pipeline en hilos: PASADO")
+
+
+def test_sandbox_paths():
+    """Test de rutas: un directorio hermano con el mismo prefijo queda fuera del sandbox."""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp) / "sandbox"
+        sibling = Path(tmp) / "sandbox2"
+        root.mkdir()
+        sibling.mkdir()
+
+        ensure_in_sandbox(root / "input" / "a.txt", root)
+        ensure_in_sandbox(root / "output" / ".." / "input" / "b.txt", root)
+
+        for outside in [sibling / "a.txt", root / ".." / "sandbox2" / "a.txt", Path(tmp) / "a.txt"]:
+            try:
+                ensure_in_sandbox(outside, root)
+            except PermissionError:
+                pass
+            else:
+                raise AssertionError(f"Ruta fuera del sandbox aceptada: {outside}")
+
+        # Una raíz relativa se resuelve contra el cwd de cada llamada
+        other = Path(tmp) / "otro"
+        (other / "sandbox").mkdir(parents=True)
+        cwd = os.getcwd()
+        try:
+            os.chdir(tmp)
+            ensure_in_sandbox(root / "a.txt", Path("sandbox"))
+            os.chdir(other)
+            ensure_in_sandbox(other / "sandbox" / "a.txt", Path("sandbox"))
+            try:
+                ensure_in_sandbox(root / "a.txt", Path("sandbox"))
+            except PermissionError:
+                pass
+            else:
+                raise AssertionError("Raíz relativa resuelta contra un cwd anterior")
+        finally:
+            os.chdir(cwd)
+    print("✓ Test rutas sandbox: PASADO")
+
+
 def test_multiple_data_sizes():
     """Test encrypt/decrypt con múltiples tamaños de datos."""
     sizes = [16, 64, 256, 1024, 4096, 16384]
     results = []
+    # Un único bloque aleatorio para todos los tamaños: sin syscalls en el bucle
+    pool = memoryview(os.urandom(max(sizes)))
+    aes = _test_aes()
 
     for size in sizes:
-        data = os.urandom(size)
+        data = pool[:size]
+        nonce = secrets.token_bytes(12)
         t0 = time.time()
-        encrypted = aesgcm_encrypt(TEST_KEY, data)
+        encrypted = aes.encrypt(nonce, data, None)
         t1 = time.time()
-        decrypted = aesgcm_decrypt(TEST_KEY, encrypted)
+        decrypted = aes.decrypt(nonce, encrypted, None)
         t2 = time.time()
 
         enc_time = t1 - t0
@@ -77,7 +257,7 @@ def test_multiple_data_sizes():
         print(f"  Tamaño {size:6d} bytes: enc={enc_time*1000:.2f}ms, dec={dec_time*1000:.2f}ms")
 
     # Guardar gráfico de tiempos
-    if HAS_MATPLOTLIB:
+    if plots_enabled():
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 5))
         
         sizes_plot = [r["size"] for r in results]
@@ -100,7 +280,7 @@ def test_multiple_data_sizes():
         ax2.grid(True, axis='y')
         
         plt.tight_layout()
-        plt.savefig(OUTPUT_DIR / "test_multiple_data_sizes.png", dpi=150)
+        plt.savefig(OUTPUT_DIR / "test_multiple_data_sizes.png", dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
         plt.close()
         print(f"  → Gráfico guardado: {OUTPUT_DIR / 'test_multiple_data_sizes.png'}")
 
@@ -134,7 +314,7 @@ def test_avalanche_effect():
         assert 0.35 < ratio < 0.65, f"Avalanche ratio fuera de rango: {ratio}"
 
     # Gráfico
-    if HAS_MATPLOTLIB:
+    if plots_enabled():
         fig, ax = plt.subplots(figsize=(10, 6))
         ax.bar([str(s) for s in data_sizes], avalanche_ratios, color='coral')
         ax.axhline(y=0.5, color='green', linestyle='--', label='Ideal (0.5)')
@@ -145,7 +325,7 @@ def test_avalanche_effect():
         ax.legend()
         ax.grid(True, axis='y')
         plt.tight_layout()
-        plt.savefig(OUTPUT_DIR / "test_avalanche_effect.png", dpi=150)
+        plt.savefig(OUTPUT_DIR / "test_avalanche_effect.png", dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
         plt.close()
         print(f"  → Gráfico guardado: {OUTPUT_DIR / 'test_avalanche_effect.png'}")
 
@@ -168,7 +348,7 @@ def test_entropy_analysis():
         assert H > 7, f"Entropía baja: {H}"
 
     # Gráfico
-    if HAS_MATPLOTLIB:
+    if plots_enabled():
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 5))
         
         ax1.plot(data_sizes, entropies, marker='o', linewidth=2, markersize=8, color='darkgreen')
@@ -181,15 +361,15 @@ def test_entropy_analysis():
         
         # Histograma de distribución de bytes en la muestra más grande
         largest_encrypted = sample_data[-1]
-        byte_counts = Counter(largest_encrypted)
-        ax2.bar(range(256), [byte_counts.get(i, 0) for i in range(256)], color='steelblue', alpha=0.7)
+        byte_counts = byte_histogram(np.frombuffer(largest_encrypted, dtype=np.uint8))
+        ax2.bar(range(256), byte_counts, color='steelblue', alpha=0.7)
         ax2.set_xlabel('Valor de Byte (0-255)')
         ax2.set_ylabel('Frecuencia')
         ax2.set_title(f'Distribución de Bytes (muestra de {data_sizes[-1]} bytes)')
         ax2.grid(True, axis='y')
         
         plt.tight_layout()
-        plt.savefig(OUTPUT_DIR / "test_entropy_analysis.png", dpi=150)
+        plt.savefig(OUTPUT_DIR / "test_entropy_analysis.png", dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
         plt.close()
         print(f"  → Gráfico guardado: {OUTPUT_DIR / 'test_entropy_analysis.png'}")
 
@@ -215,7 +395,7 @@ def test_bit_balance():
         assert abs(p1 - 0.5) < 0.05, f"Desequilibrio de bits: P(1)={p1}"
 
     # Gráfico
-    if HAS_MATPLOTLIB:
+    if plots_enabled():
         fig, ax = plt.subplots(figsize=(10, 6))
         ax.plot(data_sizes, bit_balances, marker='o', linewidth=2, markersize=8, color='purple')
         ax.axhline(y=0.05, color='red', linestyle='--', label='Límite de tolerancia (0.05)')
@@ -226,7 +406,7 @@ def test_bit_balance():
         ax.legend()
         ax.grid(True)
         plt.tight_layout()
-        plt.savefig(OUTPUT_DIR / "test_bit_balance.png", dpi=150)
+        plt.savefig(OUTPUT_DIR / "test_bit_balance.png", dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
         plt.close()
         print(f"  → Gráfico guardado: {OUTPUT_DIR / 'test_bit_balance.png'}")
 
@@ -238,19 +418,22 @@ def test_performance_benchmark():
     data_sizes = [1024, 4096, 16384, 65536, 262144, 1048576]
     throughputs_enc = []
     throughputs_dec = []
+    pool = memoryview(os.urandom(max(data_sizes)))
+    aes = _test_aes()
 
     for size in data_sizes:
-        data = os.urandom(size)
+        data = pool[:size]
+        nonce = secrets.token_bytes(12)
         
         # Encrypt
         t0 = time.time()
-        encrypted = aesgcm_encrypt(TEST_KEY, data)
+        encrypted = aes.encrypt(nonce, data, None)
         t1 = time.time()
         enc_time = t1 - t0
         
         # Decrypt
         t0 = time.time()
-        decrypted = aesgcm_decrypt(TEST_KEY, encrypted)
+        decrypted = aes.decrypt(nonce, encrypted, None)
         t1 = time.time()
         dec_time = t1 - t0
         
@@ -263,7 +446,7 @@ def test_performance_benchmark():
         print(f"  Tamaño {size:8d} bytes: Encrypt={throughput_enc:.2f} MB/s, Decrypt={throughput_dec:.2f} MB/s")
 
     # Gráfico
-    if HAS_MATPLOTLIB:
+    if plots_enabled():
         fig, ax = plt.subplots(figsize=(12, 6))
         ax.plot([s // 1024 for s in data_sizes], throughputs_enc, marker='o', label='Encrypt', linewidth=2, markersize=8)
         ax.plot([s // 1024 for s in data_sizes], throughputs_dec, marker='s', label='Decrypt', linewidth=2, markersize=8)
@@ -274,7 +457,7 @@ def test_performance_benchmark():
         ax.grid(True)
         ax.set_xscale('log')
         plt.tight_layout()
-        plt.savefig(OUTPUT_DIR / "test_performance_benchmark.png", dpi=150)
+        plt.savefig(OUTPUT_DIR / "test_performance_benchmark.png", dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
         plt.close()
         print(f"  → Gráfico guardado: {OUTPUT_DIR / 'test_performance_benchmark.png'}")
 